@@ -20,11 +20,13 @@ from telegram.ext import (
     filters,
 )
 from db import (
-    create_tables,
+    close_pool,
+    expire_membership,
     get_expired_subscriptions,
     get_user_subscription,
-    update_subscription_status,
+    open_pool,
 )
+from paystack import close_http_session, warm_http_session
 
 load_dotenv()
 
@@ -122,7 +124,9 @@ def expiry_formatting(day):
 
 
 async def check_subscription_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    subscription = get_user_subscription(update.effective_chat.id)
+    subscription = get_user_subscription(
+        update.effective_chat.id, TELEGRAM_GROUP_ID
+    )
 
     if not subscription:
         await update.message.reply_text("You do not have an active subscription")
@@ -147,10 +151,12 @@ async def check_subscription_expiry(context: ContextTypes.DEFAULT_TYPE):
     expired_subscriptions = get_expired_subscriptions()
     for subscription in expired_subscriptions:
         telegram_chat_id = subscription["telegram_chat_id"]
-        payment_reference = subscription["payment_reference"]
+        group_id = subscription["group_id"]
 
-        # Update subscription status to inactive
-        update_subscription_status(telegram_chat_id, payment_reference, "inactive")
+        # Mark the membership and its subscriptions inactive
+        if not expire_membership(group_id, telegram_chat_id):
+            # Renewed since the expired list was fetched
+            continue
 
         # Remove user from the group
         # Remove user from the group
@@ -191,6 +197,19 @@ async def check_subscription_expiry(context: ContextTypes.DEFAULT_TYPE):
             )
 
 
+async def post_init(application):
+    open_pool()
+    warm_http_session()
+    await bot_instance.initialize()
+    logging.info("Bot started")
+
+
+async def post_shutdown(application):
+    await bot_instance.shutdown()
+    close_http_session()
+    close_pool()
+    logging.info("Bot stopped")
+
 
 if __name__ == "__main__":
     from callbacks import (
@@ -200,9 +219,13 @@ if __name__ == "__main__":
         handle_gateway_selection,
     )
 
-    create_tables()
-
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     start_handler = CommandHandler("start", start)
     plans_handler = CommandHandler("plans", plans)
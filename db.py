@@ -1,5 +1,8 @@
 import os
+import csv
+import json
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 import logging
@@ -7,10 +10,54 @@ import logging
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+connection_pool = None
+
+
+def open_pool():
+    global connection_pool
+    if connection_pool is None:
+        connection_pool = ThreadedConnectionPool(
+            DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL
+        )
+        logging.info("Database connection pool opened.")
+    return connection_pool
+
+
+def close_pool():
+    global connection_pool
+    if connection_pool is not None:
+        connection_pool.closeall()
+        connection_pool = None
+        logging.info("Database connection pool closed.")
 
 
 def get_connection():
-    return psycopg2.connect(DATABASE_URL)
+    # Fall back to a one-off connection when no pool has been opened
+    if connection_pool is None:
+        return psycopg2.connect(DATABASE_URL)
+    return connection_pool.getconn()
+
+
+def release_connection(conn):
+    if connection_pool is None:
+        conn.close()
+        return
+    if conn.closed:
+        connection_pool.putconn(conn, close=True)
+        return
+    # Never hand a connection back to the pool mid-transaction
+    try:
+        conn.rollback()
+    except Exception as e:
+        logging.warning(f"Discarding broken database connection: {e}")
+        connection_pool.putconn(conn, close=True)
+        return
+    connection_pool.putconn(conn)
+
 
 def create_tables():
     conn = get_connection()
@@ -43,14 +90,72 @@ def create_tables():
             )
         """
         )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS memberships (
+                group_id TEXT NOT NULL,
+                telegram_chat_id BIGINT NOT NULL,
+                payment_reference TEXT NOT NULL,
+                username TEXT,
+                subscription_type TEXT,
+                end_date TIMESTAMP NOT NULL,
+                status TEXT NOT NULL,
+                PRIMARY KEY (group_id, telegram_chat_id)
+            )
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS memberships_active_end_date_idx
+            ON memberships (end_date)
+            WHERE status = 'active'
+        """
+        )
+        # Catch up the read model with any history it has not seen yet
+        populate_memberships(cursor)
         conn.commit()
         logging.info("Tables created successfully or already exist.")
     except Exception as e:
         logging.error(f"Error creating tables: {e}")
+        raise
     finally:
-        conn.close()
+        release_connection(conn)
+
+
+def populate_memberships(cursor):
+    # Latest subscription per (group, user) becomes the current membership.
+    # Safe to re-run: existing rows only change when history has a later end_date
+    cursor.execute(
+        """
+        INSERT INTO memberships (group_id, telegram_chat_id, payment_reference, username, subscription_type, end_date, status)
+        SELECT DISTINCT ON (group_id, telegram_chat_id)
+            group_id, telegram_chat_id, payment_reference, username, subscription_type, end_date, status
+        FROM subscriptions
+        WHERE group_id IS NOT NULL AND end_date IS NOT NULL
+        ORDER BY group_id, telegram_chat_id, end_date DESC
+        ON CONFLICT (group_id, telegram_chat_id) DO UPDATE
+        SET payment_reference = EXCLUDED.payment_reference,
+            username = EXCLUDED.username,
+            subscription_type = EXCLUDED.subscription_type,
+            end_date = EXCLUDED.end_date,
+            status = EXCLUDED.status
+        WHERE EXCLUDED.end_date > memberships.end_date
+    """
+    )
 
 
+def rebuild_memberships():
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("LOCK TABLE memberships IN EXCLUSIVE MODE")
+        cursor.execute("DELETE FROM memberships")
+        populate_memberships(cursor)
+        conn.commit()
+        logging.info(f"Memberships rebuilt with {cursor.rowcount} rows.")
+    finally:
+        release_connection(conn)
+
 
 def add_subscription(
     chat_id,
@@ -63,115 +168,262 @@ def add_subscription(
 ):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO subscriptions (telegram_chat_id, username, subscription_type, start_date, end_date, payment_reference, group_id, status)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, 'active')
-    """,
-        (
-            chat_id,
-            username,
-            subscription_type,
-            start_date,
-            end_date,
-            payment_reference,
-            group_id,
-        ),
-    )
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO subscriptions (telegram_chat_id, username, subscription_type, start_date, end_date, payment_reference, group_id, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 'active')
+        """,
+            (
+                chat_id,
+                username,
+                subscription_type,
+                start_date,
+                end_date,
+                payment_reference,
+                group_id,
+            ),
+        )
+        cursor.execute(
+            """
+            INSERT INTO memberships (group_id, telegram_chat_id, payment_reference, username, subscription_type, end_date, status)
+            VALUES (%s, %s, %s, %s, %s, %s, 'active')
+            ON CONFLICT (group_id, telegram_chat_id) DO UPDATE
+            SET payment_reference = EXCLUDED.payment_reference,
+                username = EXCLUDED.username,
+                subscription_type = EXCLUDED.subscription_type,
+                end_date = EXCLUDED.end_date,
+                status = 'active'
+            WHERE EXCLUDED.end_date >= memberships.end_date
+        """,
+            (
+                group_id,
+                chat_id,
+                payment_reference,
+                username,
+                subscription_type,
+                end_date,
+            ),
+        )
+        conn.commit()
+    finally:
+        release_connection(conn)
 
 
 def add_payment_session(user_id, payment_reference, status="pending"):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO payment_sessions (user_id, payment_reference, status)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (payment_reference) DO UPDATE
-        SET status = EXCLUDED.status
-    """,
-        (user_id, payment_reference, status),
-    )
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO payment_sessions (user_id, payment_reference, status)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (payment_reference) DO UPDATE
+            SET status = EXCLUDED.status
+        """,
+            (user_id, payment_reference, status),
+        )
+        conn.commit()
+    finally:
+        release_connection(conn)
 
 
 def update_payment_session_status(payment_reference, status):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        UPDATE payment_sessions
-        SET status = %s
-        WHERE payment_reference = %s
-    """,
-        (status, payment_reference),
-    )
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute(
+            """
+            UPDATE payment_sessions
+            SET status = %s
+            WHERE payment_reference = %s
+        """,
+            (status, payment_reference),
+        )
+        conn.commit()
+    finally:
+        release_connection(conn)
 
 
 def get_payment_session(payment_reference):
     conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT * FROM payment_sessions
-        WHERE payment_reference = %s
-    """,
-        (payment_reference,),
-    )
-    payment_session = cursor.fetchone()
-    conn.close()
-    return payment_session
+    try:
+        cursor.execute(
+            """
+            SELECT * FROM payment_sessions
+            WHERE payment_reference = %s
+        """,
+            (payment_reference,),
+        )
+        payment_session = cursor.fetchone()
+        return payment_session
+    finally:
+        release_connection(conn)
 
 
-def get_user_subscription(chat_id):
+def get_user_subscription(chat_id, group_id):
     conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT * FROM subscriptions
-        WHERE telegram_chat_id = %s
-        AND status = 'active'
-    """,
-        (chat_id,),
-    )
-    subscription = cursor.fetchone()
-    conn.close()
-
-    return subscription
+    try:
+        cursor.execute(
+            """
+            SELECT * FROM memberships
+            WHERE group_id = %s
+            AND telegram_chat_id = %s
+            AND status = 'active'
+        """,
+            (group_id, chat_id),
+        )
+        subscription = cursor.fetchone()
+        return subscription
+    finally:
+        release_connection(conn)
 
 
 def get_expired_subscriptions():
     conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
+    try:
+        cursor.execute(
+            """
+            SELECT * FROM memberships
+            WHERE end_date < CURRENT_TIMESTAMP
+            AND status = 'active'
+            ORDER BY end_date ASC
         """
-        SELECT * FROM subscriptions
-        WHERE end_date < CURRENT_TIMESTAMP
-        AND status = 'active'
-        ORDER BY end_date ASC
-    """
-    )
-    expired_subscriptions = cursor.fetchall()
-    conn.close()
-    return expired_subscriptions
+        )
+        expired_subscriptions = cursor.fetchall()
+        return expired_subscriptions
+    finally:
+        release_connection(conn)
 
 
-def update_subscription_status(chat_id, payment_reference, status):
+def expire_membership(group_id, chat_id):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        UPDATE subscriptions
-        SET status = %s
-        WHERE telegram_chat_id = %s AND payment_reference = %s
+    try:
+        cursor.execute(
+            """
+            UPDATE memberships
+            SET status = 'inactive'
+            WHERE group_id = %s AND telegram_chat_id = %s
+            AND status = 'active'
+            AND end_date < CURRENT_TIMESTAMP
+        """,
+            (group_id, chat_id),
+        )
+        expired = cursor.rowcount
+        cursor.execute(
+            """
+            UPDATE subscriptions
+            SET status = 'inactive'
+            WHERE telegram_chat_id = %s AND group_id = %s
+            AND status = 'active'
+            AND end_date < CURRENT_TIMESTAMP
+        """,
+            (chat_id, group_id),
+        )
+        conn.commit()
+        return expired
+    finally:
+        release_connection(conn)
+
+
+EXPORT_QUERIES = {
+    "payments_per_plan": """
+        SELECT group_id, date_trunc('day', start_date) AS day, subscription_type, COUNT(*) AS payments
+        FROM subscriptions
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+    """,
+    # Each subscription contributes one row per day it overlaps up to today, so
+    # the cost grows with history rather than days x history
+    "active_members": """
+        SELECT s.group_id, days.day, COUNT(DISTINCT s.telegram_chat_id) AS active_members
+        FROM subscriptions s
+        CROSS JOIN LATERAL generate_series(
+            date_trunc('day', s.start_date),
+            date_trunc('day', LEAST(s.end_date, CURRENT_TIMESTAMP)),
+            INTERVAL '1 day'
+        ) AS days(day)
+        WHERE s.start_date IS NOT NULL AND s.end_date IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
     """,
-        (status, chat_id, payment_reference),
+    # Only subscriptions not carried on by a renewal count as members leaving
+    "expiries": """
+        SELECT s.group_id, date_trunc('day', s.end_date) AS day, COUNT(*) AS expiries
+        FROM subscriptions s
+        WHERE s.end_date < CURRENT_TIMESTAMP
+        AND NOT EXISTS (
+            SELECT 1 FROM subscriptions later
+            WHERE later.telegram_chat_id = s.telegram_chat_id
+            AND later.group_id = s.group_id
+            AND later.start_date <= s.end_date
+            AND later.end_date > s.end_date
+        )
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """,
+    "subscriptions": """
+        SELECT * FROM subscriptions
+        ORDER BY start_date
+    """,
+    "payment_sessions": """
+        SELECT * FROM payment_sessions
+        ORDER BY id
+    """,
+    "memberships": """
+        SELECT * FROM memberships
+        ORDER BY group_id, telegram_chat_id
+    """,
+}
+
+
+def export_report(report, export_format, out, batch_size=EXPORT_BATCH_SIZE):
+    # Named cursors keep the result set on the server and fetch it in batches
+    conn = get_connection()
+    cursor = conn.cursor(name=f"export_{report}", cursor_factory=RealDictCursor)
+    try:
+        cursor.execute(EXPORT_QUERIES[report])
+        rows = cursor.fetchmany(batch_size)
+        if export_format == "csv":
+            columns = [column.name for column in cursor.description]
+            writer = csv.DictWriter(out, fieldnames=columns)
+            writer.writeheader()
+        while rows:
+            if export_format == "csv":
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    out.write(json.dumps(row, default=str) + "\n")
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog="python db.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate")
+    commands.add_parser("rebuild-memberships")
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("report", choices=list(EXPORT_QUERIES))
+    export_parser.add_argument(
+        "format", nargs="?", choices=["csv", "jsonl"], default="csv"
     )
-    conn.commit()
-    conn.close()
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "migrate":
+        create_tables()
+    elif args.command == "rebuild-memberships":
+        rebuild_memberships()
+    else:
+        export_report(args.report, args.format, sys.stdout)
 
@@ -0,0 +1,17 @@
+import os
+
+# Workers stop accepting requests on SIGTERM and get this long to finish
+# in-flight webhooks before they are killed
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+
+def post_worker_init(worker):
+    from webhook_server import startup
+
+    startup()
+
+
+def worker_exit(server, worker):
+    from webhook_server import shutdown
+
+    shutdown(timeout=worker.cfg.graceful_timeout)
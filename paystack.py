@@ -0,0 +1,17 @@
+import logging
+import requests
+
+# Shared keep-alive session for Paystack API calls
+http_session = requests.Session()
+
+
+def warm_http_session():
+    try:
+        http_session.head("https://api.paystack.co", timeout=5)
+        logging.info("Paystack HTTP session pre-connected")
+    except Exception as e:
+        logging.warning(f"Error pre-connecting Paystack HTTP session: {e}")
+
+
+def close_http_session():
+    http_session.close()
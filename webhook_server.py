@@ -5,11 +5,17 @@ import datetime
 import asyncio
 import logging
 import os
-import requests
+import threading
 from logging import StreamHandler
 from flask import Flask, request, Request, abort
 from dotenv import load_dotenv
-from db import add_subscription, update_payment_session_status
+from db import (
+    add_subscription,
+    close_pool,
+    open_pool,
+    update_payment_session_status,
+)
+from paystack import close_http_session, http_session, warm_http_session
 
 load_dotenv()
 
@@ -34,6 +40,66 @@ logger.setLevel(logging.INFO)
 
 bot_instance = Bot(token=BOT_TOKEN)
 
+# Event loop running Telegram sends on a background thread
+telegram_loop = None
+telegram_thread = None
+telegram_loop_lock = threading.Lock()
+
+
+def start_telegram_loop():
+    # Started lazily so the app works however it is served, not only via startup()
+    global telegram_loop, telegram_thread
+    with telegram_loop_lock:
+        if telegram_loop is None:
+            telegram_loop = asyncio.new_event_loop()
+            telegram_thread = threading.Thread(
+                target=telegram_loop.run_forever, name="telegram-loop", daemon=True
+            )
+            telegram_thread.start()
+        return telegram_loop
+
+
+def run_telegram(coro):
+    loop = start_telegram_loop()
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def startup():
+    # Warm-up failures are logged rather than raised so the worker still boots
+    try:
+        open_pool()
+    except Exception as e:
+        logger.warning(f"Error opening database pool, using direct connections: {e}")
+    warm_http_session()
+
+    try:
+        run_telegram(bot_instance.initialize())
+    except Exception as e:
+        logger.warning(f"Error initializing Telegram bot: {e}")
+    logger.info("Webhook server started")
+
+
+def shutdown(timeout=30):
+    global telegram_loop, telegram_thread
+    logger.info("Webhook server shutting down")
+    if telegram_loop is not None:
+        try:
+            run_telegram(bot_instance.shutdown())
+        except Exception as e:
+            logger.error(f"Error shutting down Telegram bot: {e}")
+        telegram_loop.call_soon_threadsafe(telegram_loop.stop)
+        telegram_thread.join(timeout=timeout)
+        if telegram_thread.is_alive():
+            logger.warning("Telegram event loop did not stop in time")
+        else:
+            telegram_loop.close()
+        telegram_loop = None
+        telegram_thread = None
+
+    close_http_session()
+    close_pool()
+    logger.info("Webhook server stopped")
+
 
 def calculate_end_date(subscription_type):
     current_date = datetime.datetime.now()
@@ -81,7 +147,7 @@ def initiate_payment(
             "username": username,
         },
     }
-    response = requests.post(url, json=data, headers=headers)
+    response = http_session.post(url, json=data, headers=headers)
     return response.json()
 
 
@@ -91,7 +157,7 @@ def verify_payment(payment_reference):
         "Authorization": f'Bearer {os.getenv("PAYSTACK_SECRET_KEY")}',
         "Content-Type": "application/json",
     }
-    response = requests.get(url, headers=headers)
+    response = http_session.get(url, headers=headers)
     logger.info(f"Payment verification response: {response.json()}")
     return response.json()
 
@@ -167,19 +233,18 @@ def paystack_webhook():
                     logger.info(f"Subscription added to database for user {username}")
 
                     # Create temporary invite link
-                    loop = asyncio.get_event_loop()
-                    invite_link = loop.run_until_complete(
+                    invite_link = run_telegram(
                         create_temporary_invite_link(bot_instance, TELEGRAM_GROUP_ID)
                     )
 
                     amount_in_naira = amount // 100
 
-                    loop.run_until_complete(
+                    run_telegram(
                         unban_user(bot_instance, TELEGRAM_GROUP_ID, telegram_chat_id)
                     )
 
                     # Notification with invite link
-                    loop.run_until_complete(
+                    run_telegram(
                         send_notification(
                             bot_instance,
                             telegram_chat_id,
@@ -201,4 +266,8 @@ def paystack_webhook():
 
 
 if __name__ == "__main__":
+    import atexit
+
+    startup()
+    atexit.register(shutdown)
     app.run(debug=True, port=4000)